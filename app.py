@@ -4,14 +4,17 @@ author : anurag pal
 """
 import threading, signal, sys, time, schedule
 import os
+import html
+import queue
 import logging
-import json
 import time
-from datetime import date, datetime
+from datetime import datetime
+from zoneinfo import ZoneInfo
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 import certifi
-import pytz
 import requests
 import schedule
 import telebot
@@ -19,6 +22,7 @@ from telebot import types
 from telebot import apihelper
 
 from databricks.sdk import WorkspaceClient
+from databricks.sdk.core import Config
 from databricks.sdk.service.jobs import RunResultState
 from dotenv import load_dotenv
 
@@ -39,14 +43,125 @@ DATABRICKS_SERVER = os.environ["DATABRICKS_SERVER"]
 DATABRICKS_TOKEN  = os.environ["DATABRICKS_TOKEN"]
 EMAIL             = os.environ["EMAIL"]
 
-bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
-TZ   = pytz.timezone("Asia/Kolkata")
+# Handlers run on a worker pool so a slow Databricks call doesn't hold up
+# other commands; outgoing messages are still serialized by _sender_loop.
+bot = telebot.TeleBot(BOT_TOKEN, threaded=True, num_threads=4)
+TZ   = ZoneInfo("Asia/Kolkata")
+TZ_OFFSET = int(datetime.now(TZ).utcoffset().total_seconds())  # IST has no DST
+
+_FAILED  = RunResultState.FAILED
+_SUCCESS = RunResultState.SUCCESS
+
+# callback_data is "<code>:<id>"; Telegram caps it at 64 bytes
+_CB_CHECK, _CB_REPAIR, _CB_PAUSE, _CB_RESUME = "s", "r", "p", "u"
+
+# ------------------------------------------------------------------
+# Shared workspace client (keeps one HTTP session / connection pool)
+# ------------------------------------------------------------------
+# The SDK mounts a pooled HTTPAdapter sized from these settings and
+# already retries 429 / 503 with backoff on top of it.
+_WS = WorkspaceClient(
+    config=Config(
+        host=DATABRICKS_SERVER,
+        token=DATABRICKS_TOKEN,
+        auth_type="pat",
+        max_connection_pools=20,
+        max_connections_per_pool=50,
+    )
+)
 
 # ------------------------------------------------------------------
-# Helper: common workspace client
+# Outgoing Telegram messages (single paced sender thread)
 # ------------------------------------------------------------------
-def _ws():
-    return WorkspaceClient(host=DATABRICKS_SERVER, token=DATABRICKS_TOKEN)
+_tg_queue = queue.Queue()
+# Everything goes to one chat, so the per-chat limits apply: ~1 msg/s for
+# a private chat, 20 msg/min for a group (negative chat ids).
+_SEND_INTERVAL = 3.0 if CHAT_ID < 0 else 1.0
+
+def _send(text, **kwargs):
+    """Queue a message to CHAT_ID; delivery happens on the sender thread."""
+    _tg_queue.put(((CHAT_ID, text), kwargs))
+
+def _sender_loop():
+    while True:
+        args, kwargs = _tg_queue.get()
+        while True:
+            try:
+                bot.send_message(*args, **kwargs)
+            except apihelper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    # Rate limited: wait as told and resend, don't drop it
+                    retry_after = (e.result_json or {}).get("parameters", {}).get("retry_after", 5)
+                    logging.warning("Telegram 429, retrying in %ss", retry_after)
+                    time.sleep(retry_after)
+                    continue
+                logging.exception("send_message failed")
+            except Exception:
+                logging.exception("send_message failed")
+            break
+        time.sleep(_SEND_INTERVAL)
+
+def _pages(items, size=10):
+    """Split items into chunks of ``size`` (one Telegram message each)."""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def _job_page_text(page):
+    """Name and ID of each job on a page, shown above its keyboard."""
+    return "\n\n".join(
+        f'{html.escape(j["name"])}\nJob ID: <code>{j["id"]}</code>' for j in page
+    )
+
+def _today_bounds_ms():
+    """[start, end) of the current day in TZ, as epoch milliseconds."""
+    start_of_day = datetime.combine(
+        datetime.now(TZ).date(), datetime.min.time(), tzinfo=TZ
+    )
+    lo = int(start_of_day.timestamp() * 1000)
+    return lo, lo + 86_400_000
+
+def _hhmm(ms):
+    """Format an epoch-milliseconds timestamp as HH:MM in TZ."""
+    hh, mm = divmod((ms // 60_000 + TZ_OFFSET // 60) % 1440, 60)
+    return f"{hh:02d}:{mm:02d}"
+
+# ------------------------------------------------------------------
+# Small TTL cache for Databricks metadata
+# ------------------------------------------------------------------
+class TTLCache:
+    """Keep computed values for ``ttl`` seconds."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._data = {}
+
+    def get_or_compute(self, key, fn):
+        hit = self._data.get(key)
+        if hit and time.monotonic() - hit[0] < self.ttl:
+            return hit[1]
+        value = fn()
+        self._data[key] = (time.monotonic(), value)
+        return value
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+_jobs_cache = TTLCache(ttl=60)
+
+def _my_jobs():
+    """Jobs created by EMAIL, shared by /jobs, /pause and /failed."""
+    return _jobs_cache.get_or_compute(
+        "mine",
+        lambda: [j for j in _WS.jobs.list() if j.creator_user_name == EMAIL],
+    )
+
+_job_cache = TTLCache(ttl=30)
+
+def _get_job(job_id):
+    """jobs.get() memoized across a burst of button clicks (read-only use)."""
+    return _job_cache.get_or_compute(job_id, lambda: _WS.jobs.get(job_id=job_id))
 
 # ------------------------------------------------------------------
 # /help
@@ -71,30 +186,22 @@ def jobs_cmd(message):
 
 def send_job_list():
     """List jobs with a ‘check status’ button for each."""
-    w = _ws()
-    jobs = [
-        {"name": j.settings.name, "id": j.job_id}
-        for j in w.jobs.list()
-        if j.creator_user_name == EMAIL
-    ]
+    jobs = [{"name": j.settings.name, "id": j.job_id} for j in _my_jobs()]
     if not jobs:
-        bot.send_message(CHAT_ID, "No jobs found for your account.")
+        _send("No jobs found for your account.")
         return
 
-    bot.send_message(CHAT_ID, f"📋 Found {len(jobs)} job(s). Tap to check today’s run:")
-    for j in jobs:
-        kb = types.InlineKeyboardMarkup()
-        kb.add(
+    _send(f"📋 Found {len(jobs)} job(s). Tap to check today’s run:")
+    for page in _pages(jobs):
+        kb = types.InlineKeyboardMarkup(row_width=1)
+        kb.add(*[
             types.InlineKeyboardButton(
-                text="📊 Check Status",
-                callback_data=json.dumps({"action": "check_status", "job_id": j["id"]}),
+                text=f'📊 {j["name"]}',
+                callback_data=f'{_CB_CHECK}:{j["id"]}',
             )
-        )
-        bot.send_message(
-            CHAT_ID,
-            f'{j["name"]}\nJob ID: `{j["id"]}`',
-            reply_markup=kb,
-        )
+            for j in page
+        ])
+        _send(_job_page_text(page), reply_markup=kb, parse_mode="HTML")
 
 # ------------------------------------------------------------------
 # /failed
@@ -103,54 +210,87 @@ def send_job_list():
 def failed_cmd(message):
     databricks_job_notification()
 
+_failed_scan_lock = threading.Lock()
+
 def databricks_job_notification():
-    """Send today’s failed runs with ‘repair’ buttons."""
-    w = _ws()
-    today = date.today()
-    failed = []
+    """Send today’s failed runs with ‘repair’ buttons; return how many.
 
-    for job in w.jobs.list():
-        if job.creator_user_name != EMAIL:
-            continue
-        for run in w.jobs.list_runs(job_id=job.job_id, expand_tasks=False):
-            if (
-                run.state.result_state == RunResultState.FAILED
-                and run.end_time
-                and datetime.fromtimestamp(run.end_time / 1000, tz=TZ).date() == today
-            ):
-                failed.append(
-                    {
-                        "job": job.settings.name,
-                        "run_id": run.run_id,
-                        "start": run.start_time,
-                        "end": run.end_time,
-                    }
+    Returns None without scanning if another scan is still running.
+    """
+    if not _failed_scan_lock.acquire(blocking=False):
+        logging.info("failure scan already running, skipping")
+        return None
+    try:
+        return _scan_failed_runs()
+    finally:
+        _failed_scan_lock.release()
+
+def _scan_failed_runs():
+    w = _WS
+    today_ms_lo, today_ms_hi = _today_bounds_ms()
+    # One workspace-wide query for recent completed runs instead of the
+    # full run history of every job; it runs alongside the job listing.
+    # A day of lookback keeps runs that started before midnight but
+    # failed today; the end_time check below picks out today's.
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        runs_future = ex.submit(
+            lambda: list(
+                w.jobs.list_runs(
+                    start_time_from=today_ms_lo - 86_400_000,
+                    completed_only=True,
+                    expand_tasks=False,
+                    limit=25,   # API maximum page size
                 )
+            )
+        )
+        my_jobs = {j.job_id: j.settings.name for j in _my_jobs()}
+        runs = runs_future.result()
 
-    if not failed:
-        bot.send_message(CHAT_ID, "🎉 No failures today!")
-        return
+    failed = []
+    for run in runs:
+        if run.job_id not in my_jobs:
+            continue
+        rs = run.state
+        if rs is None or rs.result_state is not _FAILED:
+            continue
+        if run.end_time and today_ms_lo <= run.end_time < today_ms_hi:
+            failed.append(
+                {
+                    "job": my_jobs[run.job_id],
+                    "run_id": run.run_id,
+                    "start": run.start_time,
+                    "end": run.end_time,
+                }
+            )
 
-    bot.send_message(CHAT_ID, f"❌ Found {len(failed)} failure(s) today:")
-    for f in failed:
-        print(f)
-        kb = types.InlineKeyboardMarkup()
-        kb.add(
-            types.InlineKeyboardButton(
-                text=f"🔧 Repair {f['job'][:25]}",
-                callback_data=json.dumps(
-                    {"action": "repair", "run_id": f["run_id"]}
-                ),
+    if not failed:
+        _send("🎉 No failures today!")
+        return 0
+
+    _send(f"❌ Found {len(failed)} failure(s) today:")
+    # Lines and buttons share a number so repeated failures of one job
+    # (or jobs with the same name prefix) stay distinguishable.
+    for n, f in enumerate(failed, 1):
+        f["no"] = n
+    for page in _pages(failed):
+        kb = types.InlineKeyboardMarkup(row_width=1)
+        lines = []
+        for f in page:
+            logging.debug("failed run %s/%s", f["job"], f["run_id"])
+            start = _hhmm(f["start"])
+            end   = _hhmm(f["end"])
+            kb.add(
+                types.InlineKeyboardButton(
+                    text=f"🔧 {f['no']}. Repair {f['job'][:25]} ({end})",
+                    callback_data=f"{_CB_REPAIR}:{f['run_id']}",
+                )
             )
-        )
-        start = datetime.fromtimestamp(f["start"] / 1000, tz=TZ).strftime("%H:%M")
-        end   = datetime.fromtimestamp(f["end"]   / 1000, tz=TZ).strftime("%H:%M")
-        bot.send_message(
-            CHAT_ID,
-            f"🔴 **{f['job']}**\n`{f['run_id']}`\n⏰ {start} – {end}",
-            reply_markup=kb,
-            parse_mode="Markdown",
-        )
+            lines.append(
+                f"{f['no']}. 🔴 <b>{html.escape(f['job'])}</b>\n"
+                f"<code>{f['run_id']}</code>\n⏰ {start} – {end}"
+            )
+        _send("\n\n".join(lines), reply_markup=kb, parse_mode="HTML")
+    return len(failed)
 
 # ------------------------------------------------------------------
 # /pause
@@ -161,87 +301,78 @@ def pause_cmd(message):
 
 def send_pause_job_list():
     """List jobs with Pause / Resume buttons for their schedule."""
-    w = _ws()
     jobs = [
         {
             "name": j.settings.name,
             "id": j.job_id,
             "schedule": j.settings.schedule,
         }
-        for j in w.jobs.list()
-        if j.creator_user_name == EMAIL
+        for j in _my_jobs()
     ]
 
     if not jobs:
-        bot.send_message(CHAT_ID, "No jobs found for your account.")
+        _send("No jobs found for your account.")
         return
 
-    bot.send_message(CHAT_ID, f"📋 Found {len(jobs)} job(s). Tap to pause / resume schedule:")
-    for j in jobs:
-        kb = types.InlineKeyboardMarkup()
-        if j["schedule"] and j["schedule"].pause_status != "PAUSED":
-            action, label = "pause", "⏸ Pause"
-        else:
-            action, label = "resume", "▶️ Resume"
+    _send(f"📋 Found {len(jobs)} job(s). Tap to pause / resume schedule:")
+    for page in _pages(jobs):
+        kb = types.InlineKeyboardMarkup(row_width=1)
+        for j in page:
+            if j["schedule"] and j["schedule"].pause_status != "PAUSED":
+                action, label = _CB_PAUSE, "⏸ Pause"
+            else:
+                action, label = _CB_RESUME, "▶️ Resume"
 
-        kb.add(
-            types.InlineKeyboardButton(
-                text=label,
-                callback_data=json.dumps({"action": action, "job_id": j["id"]}),
+            kb.add(
+                types.InlineKeyboardButton(
+                    text=f'{label} {j["name"]}',
+                    callback_data=f'{action}:{j["id"]}',
+                )
             )
-        )
-        bot.send_message(
-            CHAT_ID,
-            f'{j["name"]}\nJob ID: `{j["id"]}`',
-            reply_markup=kb,
-        )
+        _send(_job_page_text(page), reply_markup=kb, parse_mode="HTML")
 
 def toggle_job_schedule(job_id: int, pause: bool):
     """Pause or resume the schedule trigger of a job."""
-    w = _ws()
+    w = _WS
     try:
+        # Fresh read: the settings are written back in full, so a cached
+        # copy could overwrite recent edits to the job.
         job = w.jobs.get(job_id=job_id)
         settings = job.settings
         if not settings.schedule:
-            bot.send_message(CHAT_ID, f"Job `{job_id}` has no schedule.")
+            _send(f"Job <code>{job_id}</code> has no schedule.", parse_mode="HTML")
             return
 
         settings.schedule.pause_status = "PAUSED" if pause else "UNPAUSED"
         w.jobs.update(job_id=job_id, new_settings=settings)
+        _job_cache.invalidate(job_id)
+        _jobs_cache.invalidate("mine")
 
         verb = "paused" if pause else "resumed"
-        bot.send_message(CHAT_ID, f"✅ Schedule for `{settings.name}` has been {verb}.")
+        _send(
+            f"✅ Schedule for <b>{html.escape(settings.name)}</b> has been {verb}.",
+            parse_mode="HTML",
+        )
     except Exception as e:
-        bot.send_message(CHAT_ID, f"❌ Could not toggle schedule: {e}")
+        _send(f"❌ Could not toggle schedule: {e}")
 
 # ------------------------------------------------------------------
 # Callback dispatcher
 # ------------------------------------------------------------------
+_ACTIONS = {
+    _CB_CHECK:  ("🔍 Checking…",  lambda i: check_job_today_status(i)),
+    _CB_REPAIR: ("🔧 Repairing…", lambda i: repair_databricks_job(i)),
+    _CB_PAUSE:  ("⏸ Pausing…",    lambda i: toggle_job_schedule(i, pause=True)),
+    _CB_RESUME: ("▶️ Resuming…",  lambda i: toggle_job_schedule(i, pause=False)),
+}
+
 @bot.callback_query_handler(func=lambda call: True)
 def handle_callback(call):
     try:
-        data = json.loads(call.data)
-        action = data.get("action")
-
-        if action == "check_status":
-            job_id = data["job_id"]
-            bot.answer_callback_query(call.id, "🔍 Checking…")
-            check_job_today_status(job_id)
-
-        elif action == "repair":
-            run_id = data["run_id"]
-            bot.answer_callback_query(call.id, "🔧 Repairing…")
-            repair_databricks_job(run_id)
-
-        elif action == "pause":
-            job_id = data["job_id"]
-            bot.answer_callback_query(call.id, "⏸ Pausing…")
-            toggle_job_schedule(job_id, pause=True)
-
-        elif action == "resume":
-            job_id = data["job_id"]
-            bot.answer_callback_query(call.id, "▶️ Resuming…")
-            toggle_job_schedule(job_id, pause=False)
+        code, _, arg = call.data.partition(":")
+        answer, action = _ACTIONS[code]
+        bot.answer_callback_query(call.id, answer)
+        action(int(arg))
 
     except Exception as e:
         bot.answer_callback_query(call.id, "❌ Error processing request")
@@ -250,64 +381,76 @@ def handle_callback(call):
 # ------------------------------------------------------------------
 # Status checker (used by /jobs)
 # ------------------------------------------------------------------
+RUNS_PAGE_LIMIT = 20
+
 def check_job_today_status(job_id):
-    today = date.today()
-    w = _ws()
+    today_ms_lo, today_ms_hi = _today_bounds_ms()
+    w = _WS
     try:
-        job = w.jobs.get(job_id=job_id)
-        runs_today = [
-            r
-            for r in w.jobs.list_runs(job_id=job_id, expand_tasks=False)
-            if (
-                r.start_time
-                and datetime.fromtimestamp(r.start_time / 1000, tz=TZ).date() == today
-            )
-        ]
+        job = _get_job(job_id)
+        name = html.escape(job.settings.name)
+        # Runs come back newest first: stop at the first one before today
+        # even if the server-side window is ignored, and never read past
+        # the first page.
+        runs_today = []
+        for r in islice(
+            w.jobs.list_runs(
+                job_id=job_id,
+                expand_tasks=False,
+                start_time_from=today_ms_lo,
+                start_time_to=today_ms_hi,
+                limit=RUNS_PAGE_LIMIT,
+            ),
+            RUNS_PAGE_LIMIT,
+        ):
+            if not r.start_time:
+                continue
+            if r.start_time < today_ms_lo:
+                break
+            if r.start_time < today_ms_hi:
+                runs_today.append(r)
         if not runs_today:
-            bot.send_message(
-                CHAT_ID,
-                f"📅 **{job.settings.name}**\nNo runs today.",
-                parse_mode="Markdown",
-            )
+            _send(f"📅 <b>{name}</b>\nNo runs today.", parse_mode="HTML")
             return
 
         r = max(runs_today, key=lambda x: x.start_time)
-        start = datetime.fromtimestamp(r.start_time / 1000, tz=TZ).strftime("%H:%M")
+        start = _hhmm(r.start_time)
         if r.end_time:
-            end = datetime.fromtimestamp(r.end_time / 1000, tz=TZ).strftime("%H:%M")
+            end = _hhmm(r.end_time)
             dur = f"{start} – {end}"
         else:
             dur = f"Started {start} (still running)"
 
-        if r.state.result_state == RunResultState.SUCCESS:
-            msg = f"✅ **{job.settings.name}**\nSUCCESS\n⏰ {dur}\nRun `{r.run_id}`"
-        elif r.state.result_state == RunResultState.FAILED:
+        result_state = r.state.result_state if r.state else None
+        if result_state is _SUCCESS:
+            msg = f"✅ <b>{name}</b>\nSUCCESS\n⏰ {dur}\nRun <code>{r.run_id}</code>"
+        elif result_state is _FAILED:
             kb = types.InlineKeyboardMarkup()
             kb.add(
                 types.InlineKeyboardButton(
                     "🔧 Repair",
-                    callback_data=json.dumps({"action": "repair", "run_id": r.run_id}),
+                    callback_data=f"{_CB_REPAIR}:{r.run_id}",
                 )
             )
             msg = (
-                f"❌ **{job.settings.name}**\nFAILED\n⏰ {dur}\n"
-                f"Run `{r.run_id}`\n{r.state.state_message or ''}"
+                f"❌ <b>{name}</b>\nFAILED\n⏰ {dur}\n"
+                f"Run <code>{r.run_id}</code>\n{html.escape(r.state.state_message or '')}"
             )
-            bot.send_message(CHAT_ID, msg, reply_markup=kb, parse_mode="Markdown")
+            _send(msg, reply_markup=kb, parse_mode="HTML")
             return
         else:
-            msg = f"🔄 **{job.settings.name}**\nRUNNING\n⏰ {dur}\nRun `{r.run_id}`"
+            msg = f"🔄 <b>{name}</b>\nRUNNING\n⏰ {dur}\nRun <code>{r.run_id}</code>"
 
-        bot.send_message(CHAT_ID, msg, parse_mode="Markdown")
+        _send(msg, parse_mode="HTML")
 
     except Exception as e:
-        bot.send_message(CHAT_ID, f"❌ Error: {e}")
+        _send(f"❌ Error: {e}")
 
 # ------------------------------------------------------------------
 # Repair helper
 # ------------------------------------------------------------------
 def repair_databricks_job(run_id):
-    w = _ws()
+    w = _WS
     try:
         resp = w.jobs.repair_run(
                 run_id,
@@ -325,21 +468,48 @@ def repair_databricks_job(run_id):
         )
             
         except Exception as e:
-            bot.send_message(CHAT_ID, f"❌ Repair failed: {e}")
+            _send(f"❌ Repair failed: {e}")
             return
 
     # if we reach here, one of the calls succeeded
-    bot.send_message(
-        CHAT_ID,
-        f"✅ Repair started!\nOriginal: `{run_id}`\nRepair run: `{resp.run_id}`",
+    _send(
+        f"✅ Repair started!\nOriginal: <code>{run_id}</code>\n"
+        f"Repair run: <code>{resp.run_id}</code>",
+        parse_mode="HTML",
     )
 
 
 times = ("07:45", "08:30", "09:30", "11:00", "12:00",
          "13:00", "15:00", "18:00", "20:20", "23:30")
 
+# After this many clean scheduled scans in a row, every other slot is
+# skipped until a failure shows up again.
+CLEAN_STREAK_BACKOFF = 3
+_last_check_state = {"clean_streak": 0, "skip": 0}
+
+def scheduled_failure_scan():
+    st = _last_check_state
+    if st["skip"]:
+        st["skip"] -= 1
+        return
+    # Errors must not escape: schedule only books the next run after the
+    # job returns, so a raising job stays overdue and re-fires at once.
+    try:
+        n_failed = databricks_job_notification()
+    except Exception:
+        logging.exception("scheduled failure scan error")
+        return
+    if n_failed is None:
+        return
+    if n_failed:
+        st["clean_streak"] = 0
+    else:
+        st["clean_streak"] += 1
+        if st["clean_streak"] >= CLEAN_STREAK_BACKOFF:
+            st["skip"] = 1
+
 for t in times:
-    schedule.every().day.at(t).do(databricks_job_notification)
+    schedule.every().day.at(t).do(scheduled_failure_scan)
 
 
 def polling_worker():
@@ -359,14 +529,26 @@ if __name__ == "__main__":
         format="%(asctime)s %(levelname)s %(message)s",
     )
 
-    # First run
-    databricks_job_notification()
+    # Start the Telegram sender before anything queues messages
+    sender_thread = threading.Thread(target=_sender_loop, daemon=True)
+    sender_thread.start()
 
-    # Start Telegram polling in a daemon thread
+    # Start Telegram polling in a daemon thread, so commands are answered
+    # while the first scan is still talking to Databricks
     polling_thread = threading.Thread(target=polling_worker, daemon=True)
     polling_thread.start()
 
-    # Main loop for the scheduler
+    # First run
+    try:
+        databricks_job_notification()
+    except Exception:
+        logging.exception("initial failure scan error")
+
+    # Main loop for the scheduler: sleep until the next job is due
+    # (capped, so clock jumps are picked up) instead of ticking every second.
+    # A job still overdue right after run_pending() means it didn't get
+    # rescheduled; wait the full cap rather than spinning on it.
     while True:
         schedule.run_pending()
-        time.sleep(1)
+        idle = schedule.idle_seconds()
+        time.sleep(60 if idle is None or idle <= 0 else min(idle, 60))